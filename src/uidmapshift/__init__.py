@@ -1,5 +1,4 @@
 import argparse
-import dataclasses
 import sys
 
 from ._version import __version__
@@ -53,7 +52,7 @@ def parse_args() -> argparse.Namespace:
         "--exclude-path",
         action="append",
         default=list(),
-        help="path to exclude from shifting (cumulative)",
+        help="path to exclude from shifting, along with its contents for directories (cumulative)",
     )
 
     group = parser.add_mutually_exclusive_group()
@@ -90,6 +89,24 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="list skipped files/directories (overridden by --quiet)",
     )
+    parser.add_argument(
+        "-k",
+        "--continue-on-error",
+        action="store_true",
+        help="report the files/dirs that fail to be shifted (I/O errors or out-of-range new UIDs/GIDs) and carry on, instead of stopping at the first failure",
+    )
+    parser.add_argument(
+        "--assume-cached",
+        action="store_true",
+        help="trust the cached file attributes instead of revalidating them (faster on network filesystems)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of worker threads performing the shifts (default: 4 per CPU)",
+    )
     parser.add_argument(
         "offset",
         type=_parse_offsets,
@@ -113,6 +130,9 @@ def main() -> None:
         dry_run=args.dry_run,
         quiet=args.quiet,
         show_skips=args.show_skips,
+        continue_on_error=args.continue_on_error,
+        assume_cached=args.assume_cached,
+        max_workers=args.jobs,
     )
     shifter = Shifter(
         uid_offset,
@@ -127,7 +147,16 @@ def main() -> None:
             # Do a dry run first to weed out any obvious issues.
             # Obviously this is not fool-proof as it can fall victim to TOCTOU issues.
             print("[+] Performing sanity-check dry-run...", file=sys.stderr)
-            dry_opts = dataclasses.replace(opts, dry_run=True, quiet=True)
+            dry_opts = ShifterOptions(
+                shift_owner=opts.shift_owner,
+                shift_acl=opts.shift_acl,
+                dry_run=True,
+                quiet=True,
+                show_skips=opts.show_skips,
+                continue_on_error=opts.continue_on_error,
+                assume_cached=opts.assume_cached,
+                max_workers=opts.max_workers,
+            )
             dry_stats = shifter.run(args.path, options=dry_opts)
             print(
                 f"[+] Dry-run shifted files/dirs: {dry_stats.shifted_paths} (uids:{dry_stats.shifted_uids} gids:{dry_stats.shifted_gids} acls:{dry_stats.shifted_acls} default-acls:{dry_stats.shifted_default_acls})",
@@ -136,7 +165,17 @@ def main() -> None:
             print(
                 f"[+] Dry-run skipped files/dirs: {dry_stats.skipped}", file=sys.stderr
             )
-            print("[+] All good, doing the real thing now", file=sys.stderr)
+            if dry_stats.errors:
+                print(
+                    f"[!] Dry-run failed files/dirs: {dry_stats.errors}",
+                    file=sys.stderr,
+                )
+                print(
+                    "[!] Doing the real thing anyway, failures will be skipped",
+                    file=sys.stderr,
+                )
+            else:
+                print("[+] All good, doing the real thing now", file=sys.stderr)
         else:
             print("[!] Leeeeroy Jenkins!", file=sys.stderr)
 
@@ -146,3 +185,6 @@ def main() -> None:
         file=sys.stderr,
     )
     print(f"[+] Skipped files/dirs: {stats.skipped}", file=sys.stderr)
+    if stats.errors:
+        print(f"[!] Failed files/dirs: {stats.errors}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,92 @@
+"""Minimal ctypes binding to statx(2), to stat files without forcing the revalidation
+of their attributes on network filesystems (`AT_STATX_DONT_SYNC`)."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+from typing import NamedTuple
+
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+AT_STATX_DONT_SYNC = 0x4000
+
+STATX_TYPE = 0x1
+STATX_MODE = 0x2
+STATX_UID = 0x8
+STATX_GID = 0x10
+
+
+class _Statx(ctypes.Structure):
+    # Only the leading fields of struct statx are needed, the rest is padding.
+    _fields_ = [
+        ("stx_mask", ctypes.c_uint32),
+        ("stx_blksize", ctypes.c_uint32),
+        ("stx_attributes", ctypes.c_uint64),
+        ("stx_nlink", ctypes.c_uint32),
+        ("stx_uid", ctypes.c_uint32),
+        ("stx_gid", ctypes.c_uint32),
+        ("stx_mode", ctypes.c_uint16),
+        ("_spare", ctypes.c_uint8 * 226),
+    ]
+
+
+class StatxResult(NamedTuple):
+    st_mode: int
+    st_uid: int
+    st_gid: int
+
+
+def _load_statx():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        statx = libc.statx
+    except (OSError, AttributeError):
+        return None
+    statx.argtypes = [
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_int,
+        ctypes.c_uint,
+        ctypes.POINTER(_Statx),
+    ]
+    statx.restype = ctypes.c_int
+    return statx
+
+
+_statx = _load_statx()
+
+
+def stat_cached(
+    path: str, *, dir_fd: int | None = None, follow_symlinks: bool = True
+) -> StatxResult | os.stat_result:
+    """Like `os.stat()`, but lets the kernel answer from its attribute cache.
+
+    Only `st_mode`, `st_uid` and `st_gid` are guaranteed to be available in the
+    result. Falls back to `os.stat()` if statx(2) is not supported."""
+
+    global _statx
+
+    if _statx is not None:
+        buf = _Statx()
+        flags = AT_STATX_DONT_SYNC
+        if not follow_symlinks:
+            flags |= AT_SYMLINK_NOFOLLOW
+        ret = _statx(
+            AT_FDCWD if dir_fd is None else dir_fd,
+            os.fsencode(path),
+            flags,
+            STATX_TYPE | STATX_MODE | STATX_UID | STATX_GID,
+            ctypes.byref(buf),
+        )
+        if ret == 0:
+            return StatxResult(buf.stx_mode, buf.stx_uid, buf.stx_gid)
+
+        err = ctypes.get_errno()
+        if err == errno.ENOSYS:
+            # Not supported by the kernel, don't bother trying again.
+            _statx = None
+        elif err != errno.EINVAL:
+            raise OSError(err, os.strerror(err), path)
+
+    return os.stat(path, dir_fd=dir_fd, follow_symlinks=follow_symlinks)
@@ -1,23 +1,176 @@
+import errno
 import fnmatch
 import os
-from dataclasses import dataclass
-from pathlib import Path
+import re
+import stat
+import sys
+from array import array
+from bisect import bisect_right
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import PurePath
 
 import posix1e
 
+from ._statx import stat_cached
+
 MAX_ID = 1 << 32
 
 
-@dataclass
+def _default_max_workers() -> int:
+    return (os.cpu_count() or 1) * 4
+
+
+def _has_xattr(path: str, name: str) -> bool:
+    try:
+        os.getxattr(path, name, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in (errno.ENODATA, errno.EOPNOTSUPP):
+            return False
+        raise
+    return True
+
+
+def _display_path(path: str, is_dir: bool) -> str:
+    # Mark directories with a trailing "/", unless already there (e.g. for "/").
+    return path + "/" if is_dir and not path.endswith("/") else path
+
+
+def _entry_path(dir_path: str, entry: os.DirEntry[str]) -> str:
+    # Like pathlib, don't prefix the entries of the current directory with "./".
+    return entry.name if dir_path == "." else entry.path
+
+
+def _run_batches[R](
+    fn: Callable[..., R], batches: Iterable[tuple], max_workers: int
+) -> Iterator[R]:
+    """Yields `fn(*batch)` for each batch, in order, computed by `max_workers` threads.
+
+    At most `2 * max_workers` batches are in flight, so that the walk doesn't queue up
+    the whole tree ahead of the workers. If a batch fails, the batches not started
+    yet are cancelled, but those already running still complete."""
+
+    if max_workers <= 1:
+        # No concurrency requested: don't pay for the pool and its hand-offs.
+        for batch in batches:
+            yield fn(*batch)
+        return
+
+    max_in_flight = 2 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures: deque[Future[R]] = deque()
+        try:
+            for batch in batches:
+                if len(futures) >= max_in_flight:
+                    yield futures.popleft().result()
+                futures.append(executor.submit(fn, *batch))
+            while futures:
+                yield futures.popleft().result()
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
+def _merge_ranges(ranges: list[range]) -> tuple[list[int], list[int]]:
+    """Returns the sorted starts and stops of the disjoint union of the ranges."""
+
+    starts: list[int] = []
+    stops: list[int] = []
+    for r in sorted(ranges, key=lambda r: r.start):
+        if r.start >= r.stop:
+            continue
+        if stops and r.start <= stops[-1]:
+            stops[-1] = max(stops[-1], r.stop)
+        else:
+            starts.append(r.start)
+            stops.append(r.stop)
+    return (starts, stops)
+
+
+def _make_id_shifter(
+    kind: str, offset: int, exclude_ranges: list[range]
+) -> Callable[[int], int]:
+    """Returns a function mapping an ID to its shifted value, or -1 if unchanged.
+
+    The function is specialized for the given offset and exclusions, so that the
+    common cases don't pay for the checks they don't need."""
+
+    if offset == 0:
+        # The new ID would be the same: spare the useless chown/ACL update.
+        return lambda _: -1
+
+    def shift_id(old_id: int) -> int:
+        new_id = old_id + offset
+        if not 0 <= new_id < MAX_ID:
+            raise ValueError(f"Invalid new {kind}: {old_id} -> {new_id}")
+        return new_id
+
+    starts, stops = _merge_ranges(exclude_ranges)
+    if not starts:
+        return shift_id
+
+    def shift_id_with_exclusions(old_id: int) -> int:
+        i = bisect_right(starts, old_id) - 1
+        if i >= 0 and old_id < stops[i]:
+            return -1
+        new_id = old_id + offset
+        if not 0 <= new_id < MAX_ID:
+            raise ValueError(f"Invalid new {kind}: {old_id} -> {new_id}")
+        return new_id
+
+    return shift_id_with_exclusions
+
+
+@dataclass(slots=True, frozen=True)
 class ShifterOptions:
     shift_owner: bool = True
     shift_acl: bool = True
     dry_run: bool = False
     quiet: bool = False
     show_skips: bool = False
-
-
-@dataclass
+    continue_on_error: bool = False
+    assume_cached: bool = False
+    # Defaults to 4 worker threads per CPU.
+    max_workers: int | None = None
+
+
+@dataclass(slots=True)
+class _Plan:
+    """Changes planned for a batch of paths.
+
+    Stored column-wise, with the IDs in typed arrays, to keep plans for large trees
+    compact. The paths are names relative to `dir_path` if set, full paths otherwise.
+    The ACLs, rarely present, are indexed by position in the batch, along with their
+    number of shifted entries."""
+
+    dir_path: str | None = None
+    # Whether `dir_path` may be a symlink to a directory (only for the root path).
+    follow_dir_symlink: bool = False
+    names: list[str] = field(default_factory=list)
+    new_uids: array[int] = field(default_factory=lambda: array("q"))
+    new_gids: array[int] = field(default_factory=lambda: array("q"))
+    acls: dict[int, tuple[posix1e.ACL, int]] = field(default_factory=dict)
+    default_acls: dict[int, tuple[posix1e.ACL, int]] = field(default_factory=dict)
+
+    def path(self, i: int) -> str:
+        name = self.names[i]
+        if self.dir_path is None or self.dir_path == ".":
+            return name
+        return os.path.join(self.dir_path, name)
+
+    def open_dir(self) -> int:
+        """Opens `dir_path` for use as a `dir_fd`."""
+
+        assert self.dir_path is not None
+        flags = os.O_PATH | os.O_DIRECTORY
+        if not self.follow_dir_symlink:
+            flags |= os.O_NOFOLLOW
+        return os.open(self.dir_path, flags)
+
+
+@dataclass(slots=True)
 class ShifterStats:
     shifted_paths: int = 0
     shifted_uids: int = 0
@@ -25,6 +178,63 @@ class ShifterStats:
     shifted_acls: int = 0
     shifted_default_acls: int = 0
     skipped: int = 0
+    errors: int = 0
+
+    def merge(self, other: "ShifterStats") -> None:
+        self.shifted_paths += other.shifted_paths
+        self.shifted_uids += other.shifted_uids
+        self.shifted_gids += other.shifted_gids
+        self.shifted_acls += other.shifted_acls
+        self.shifted_default_acls += other.shifted_default_acls
+        self.skipped += other.skipped
+        self.errors += other.errors
+
+
+def _handle_shift_error(
+    path: str, e: OSError | ValueError, options: ShifterOptions, stats: ShifterStats
+) -> None:
+    """Reports the failure to shift `path` if continuing on errors, raises it otherwise."""
+
+    if isinstance(e, OSError):
+        message = f"Failed to shift UID/GID for: {path}: {e.strerror or e}"
+    else:
+        message = f"Failed to shift UID/GID for: {path}: {e}"
+    if not options.continue_on_error:
+        if isinstance(e, ValueError):
+            raise ValueError(message) from e
+        if e.errno is None:
+            raise OSError(message) from e
+        raise OSError(e.errno, message) from e
+    stats.errors += 1
+    print(f"[!] {message}", file=sys.stderr)
+
+
+def _uncount_shift(
+    plan: _Plan,
+    i: int,
+    stats: ShifterStats,
+    *,
+    path: bool = True,
+    owner: bool = True,
+    acl: bool = True,
+    default_acl: bool = True,
+) -> None:
+    """Takes back the planned shifts of the `i`-th path of `plan` that didn't happen.
+
+    `path` is whether nothing at all was applied to the path, in which case it is no
+    longer counted as shifted. A partially shifted path still counts as shifted."""
+
+    if path:
+        stats.shifted_paths -= 1
+    if owner:
+        if plan.new_uids[i] != -1:
+            stats.shifted_uids -= 1
+        if plan.new_gids[i] != -1:
+            stats.shifted_gids -= 1
+    if acl and i in plan.acls:
+        stats.shifted_acls -= plan.acls[i][1]
+    if default_acl and i in plan.default_acls:
+        stats.shifted_default_acls -= plan.default_acls[i][1]
 
 
 class Shifter:
@@ -41,30 +251,15 @@ class Shifter:
         self.exclude_uid_ranges = exclude_uid_ranges
         self.exclude_gid_ranges = exclude_gid_ranges
         self.exclude_paths = exclude_paths
-
-    def new_uid(self, uid: int) -> int:
-        """Returns -1 if unchanged."""
-
-        if any(uid in r for r in self.exclude_uid_ranges):
-            return -1
-
-        new_uid = uid + self.uid_offset
-        if new_uid not in range(0, MAX_ID):
-            raise ValueError(f"Invalid new UID: {uid} -> {new_uid}")
-
-        return new_uid
-
-    def new_gid(self, gid: int) -> int:
-        """Returns -1 if unchanged."""
-
-        if any(gid in r for r in self.exclude_gid_ranges):
-            return -1
-
-        new_gid = gid + self.gid_offset
-        if new_gid not in range(0, MAX_ID):
-            raise ValueError(f"Invalid new GID: {gid} -> {new_gid}")
-
-        return new_gid
+        # Both return -1 if unchanged.
+        self.new_uid = _make_id_shifter("UID", uid_offset, exclude_uid_ranges)
+        self.new_gid = _make_id_shifter("GID", gid_offset, exclude_gid_ranges)
+        # Match all the exclusion globs in one go rather than one fnmatch per glob.
+        self._exclude_re = (
+            re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in exclude_paths))
+            if exclude_paths
+            else None
+        )
 
     def shift_acl(self, acl: posix1e.ACL, is_default: bool) -> list[str]:
         """Returns the string description of the entries modified in the ACL."""
@@ -92,21 +287,42 @@ class Shifter:
 
         return modified
 
-    def shift(
+    def _plan(
         self,
-        path: Path,
-        options: ShifterOptions = ShifterOptions(),
-        stats: ShifterStats = ShifterStats(),
+        path: str,
+        options: ShifterOptions,
+        stats: ShifterStats,
+        *,
+        is_dir: bool | None = None,
+        dir_fd: int | None = None,
+        name: str | None = None,
+        out: list[str] | None = None,
+        plan: _Plan,
     ) -> bool:
-        """Returns `True` if shifted."""
+        """Adds the changes to make on `path` to `plan`. Returns `True` if any.
+
+        `dir_fd` and `name` must be given if and only if `plan.dir_path` is set.
+        See `shift()` for the other arguments."""
 
-        is_dir = path.is_dir(follow_symlinks=False)
+        write = out.append if out is not None else sys.stdout.write
 
-        if any(fnmatch.fnmatch(str(path), pat) for pat in self.exclude_paths):
+        if dir_fd is None or name is None:
+            target = path
+            dir_fd = None
+        else:
+            target = name
+
+        if self._exclude_re is not None and self._exclude_re.match(path):
             stats.skipped += 1
             if not options.quiet and options.show_skips:
-                suffix = "/" if is_dir else ""
-                print(f"{path}{suffix}: skip")
+                if is_dir is None:
+                    try:
+                        st = os.stat(target, dir_fd=dir_fd, follow_symlinks=False)
+                        is_dir = stat.S_ISDIR(st.st_mode)
+                    except OSError:
+                        # Only for display, just like Path.is_dir().
+                        is_dir = False
+                write(f"{_display_path(path, is_dir)}: skip\n")
             return False
 
         try:
@@ -120,21 +336,28 @@ class Shifter:
             modified_acl_entries = []
             modified_default_acl_entries = []
 
-            stat = os.stat(path, follow_symlinks=False)
-            uid = stat.st_uid
-            gid = stat.st_gid
+            stat_fn = stat_cached if options.assume_cached else os.stat
+            st = stat_fn(target, dir_fd=dir_fd, follow_symlinks=False)
+            uid = st.st_uid
+            gid = st.st_gid
+            # Trust the file type from this stat, rather than the caller's hint or
+            # additional stats.
+            is_dir = stat.S_ISDIR(st.st_mode)
+            is_symlink = stat.S_ISLNK(st.st_mode)
 
             if options.shift_owner:
                 new_uid = self.new_uid(uid)
                 new_gid = self.new_gid(gid)
 
-            # Symlinks cannot have ACLs.
-            if options.shift_acl and not path.is_symlink():
-                acl = posix1e.ACL(file=path)
-                modified_acl_entries = self.shift_acl(acl, False)
-                new_acl = len(modified_acl_entries) > 0
+            # Symlinks cannot have ACLs. Also, ACLs that only mirror the file mode
+            # (hence without any UID/GID) are not stored, so only load stored ones.
+            if options.shift_acl and not is_symlink:
+                if _has_xattr(path, "system.posix_acl_access"):
+                    acl = posix1e.ACL(file=path)
+                    modified_acl_entries = self.shift_acl(acl, False)
+                    new_acl = len(modified_acl_entries) > 0
 
-                if is_dir:
+                if is_dir and _has_xattr(path, "system.posix_acl_default"):
                     default_acl = posix1e.ACL(filedef=path)
                     modified_default_acl_entries = self.shift_acl(default_acl, True)
                     new_default_acl = len(modified_default_acl_entries) > 0
@@ -142,8 +365,7 @@ class Shifter:
             if new_uid == -1 and new_gid == -1 and not new_acl and not new_default_acl:
                 stats.skipped += 1
                 if not options.quiet and options.show_skips:
-                    suffix = "/" if is_dir else ""
-                    print(f"{path}{suffix}: {uid}:{gid} skip")
+                    write(f"{_display_path(path, is_dir)}: {uid}:{gid} skip\n")
                 return False
 
             stats.shifted_paths += 1
@@ -157,46 +379,255 @@ class Shifter:
                 stats.shifted_default_acls += len(modified_default_acl_entries)
 
             if not options.quiet:
-                suffix = "/" if is_dir else ""
                 show_uid = uid if new_uid == -1 else new_uid
                 show_gid = gid if new_gid == -1 else new_gid
-                heading = f"{path}{suffix}:"
+                heading = _display_path(path, is_dir) + ":"
                 n = len(heading)
                 if options.shift_owner:
-                    print(f"{heading} {uid}:{gid} -> {show_uid}:{show_gid}")
+                    write(f"{heading} {uid}:{gid} -> {show_uid}:{show_gid}\n")
                     heading = n * " "
                 if options.shift_acl:
                     for entry in modified_acl_entries:
-                        print(f"{heading} {entry}")
+                        write(f"{heading} {entry}\n")
                         heading = n * " "
                     for entry in modified_default_acl_entries:
-                        print(f"{heading} {entry}")
+                        write(f"{heading} {entry}\n")
 
-            if not options.dry_run:
-                if new_uid != -1 or new_gid != -1:
-                    os.chown(path, new_uid, new_gid, follow_symlinks=False)
-                if new_acl:
-                    assert acl is not None
-                    acl.applyto(path)
-                if new_default_acl:
-                    assert default_acl is not None
-                    default_acl.applyto(path, posix1e.ACL_TYPE_DEFAULT)
+            i = len(plan.names)
+            plan.names.append(target)
+            plan.new_uids.append(new_uid)
+            plan.new_gids.append(new_gid)
+            if new_acl:
+                assert acl is not None
+                plan.acls[i] = (acl, len(modified_acl_entries))
+            if new_default_acl:
+                assert default_acl is not None
+                plan.default_acls[i] = (default_acl, len(modified_default_acl_entries))
 
             return True
-        except:
-            raise RuntimeError(f"Failed to shift UID/GID for: {path}")
+        except (OSError, ValueError) as e:
+            _handle_shift_error(path, e, options, stats)
+            return False
+
+    def _apply(
+        self,
+        plan: _Plan,
+        options: ShifterOptions,
+        stats: ShifterStats,
+        dir_fd: int | None = None,
+    ) -> None:
+        """Performs the changes in `plan`.
+
+        `dir_fd` must be given, referring to `plan.dir_path`, if the latter is set."""
+
+        new_uids = plan.new_uids
+        new_gids = plan.new_gids
+        acls = plan.acls
+        default_acls = plan.default_acls
+        for i, name in enumerate(plan.names):
+            owner_done = False
+            acl_done = False
+            try:
+                new_uid = new_uids[i]
+                new_gid = new_gids[i]
+                if new_uid != -1 or new_gid != -1:
+                    os.chown(
+                        name, new_uid, new_gid, dir_fd=dir_fd, follow_symlinks=False
+                    )
+                owner_done = True
+                if i in acls:
+                    acls[i][0].applyto(plan.path(i))
+                acl_done = True
+                if i in default_acls:
+                    default_acls[i][0].applyto(plan.path(i), posix1e.ACL_TYPE_DEFAULT)
+            except OSError as e:
+                _handle_shift_error(plan.path(i), e, options, stats)
+                # Only count what was actually shifted.
+                chowned = owner_done and (new_uids[i] != -1 or new_gids[i] != -1)
+                acl_applied = acl_done and i in acls
+                _uncount_shift(
+                    plan,
+                    i,
+                    stats,
+                    path=not chowned and not acl_applied,
+                    owner=not owner_done,
+                    acl=not acl_done,
+                )
+
+    def shift(
+        self,
+        path: str,
+        options: ShifterOptions = ShifterOptions(),
+        stats: ShifterStats = ShifterStats(),
+        *,
+        is_dir: bool | None = None,
+        dir_fd: int | None = None,
+        name: str | None = None,
+        out: list[str] | None = None,
+    ) -> bool:
+        """Returns `True` if shifted.
+
+        The file type is taken from the stat of `path`, `is_dir` is only a hint used
+        when listing excluded paths without stat'ing them.
+
+        If `dir_fd` is given, it must refer to the directory containing `path`, whose
+        last component is `name`: syscalls are then issued relative to it rather than
+        resolving the full path every time.
+
+        If `out` is given, the output lines are appended to it instead of being
+        written to stdout."""
+
+        relative = dir_fd is not None and name is not None
+        plan = _Plan(os.path.dirname(path) if relative else None)
+        if not self._plan(
+            path,
+            options,
+            stats,
+            is_dir=is_dir,
+            dir_fd=dir_fd if relative else None,
+            name=name if relative else None,
+            out=out,
+            plan=plan,
+        ):
+            return False
+        if not options.dry_run:
+            self._apply(plan, options, stats, dir_fd if relative else None)
+        return True
+
+    def _walk(
+        self, path: str, options: ShifterOptions, stats: ShifterStats
+    ) -> Iterator[tuple[str, list[os.DirEntry[str]]]]:
+        """Yields each directory under `path` along with its entries.
+
+        Excluded directories are pruned: their entries are not listed. Directories
+        that cannot be listed are handled as failures to shift them."""
+
+        exclude_re = self._exclude_re
+        if exclude_re is None:
+            pending = [path]
+        else:
+            pending = [] if exclude_re.match(path) else [path]
+        while pending:
+            dir_path = pending.pop()
+            try:
+                with os.scandir(dir_path) as it:
+                    entries = list(it)
+            except NotADirectoryError:
+                # Same as os.walk(): nothing to list under a root path that isn't a
+                # directory (or a directory replaced by a file in the meantime).
+                continue
+            except OSError as e:
+                _handle_shift_error(dir_path, e, options, stats)
+                continue
+            subdirs = (
+                _entry_path(dir_path, e)
+                for e in entries
+                if e.is_dir(follow_symlinks=False)
+            )
+            if exclude_re is None:
+                pending.extend(subdirs)
+            else:
+                pending.extend(d for d in subdirs if not exclude_re.match(d))
+            if entries:
+                yield (dir_path, entries)
+
+    def _plan_batch(
+        self,
+        dir_path: str,
+        entries: list[os.DirEntry[str]],
+        options: ShifterOptions,
+        is_root: bool,
+    ) -> tuple[_Plan, ShifterStats, list[str]]:
+        # Each batch gets its own stats, merged by the caller: no locking needed.
+        stats = ShifterStats()
+        # Likewise for the output, written by the caller in one go, in walk order.
+        out: list[str] = []
+        # Like os.walk(), follow the root path if it is a symlink to a directory. The
+        # other directories were found by _walk() not to be symlinks.
+        plan = _Plan(dir_path, follow_dir_symlink=is_root)
+        # Resolve the directory once, then stat its entries relative to it.
+        try:
+            dir_fd = plan.open_dir()
+        except OSError as e:
+            _handle_shift_error(dir_path, e, options, stats)
+            return (plan, stats, out)
+        # Hoist the lookups out of the loop.
+        plan_entry = self._plan
+        try:
+            for entry in entries:
+                plan_entry(
+                    _entry_path(dir_path, entry),
+                    options,
+                    stats,
+                    # Already cached by _walk().
+                    is_dir=entry.is_dir(follow_symlinks=False),
+                    dir_fd=dir_fd,
+                    name=entry.name,
+                    out=out,
+                    plan=plan,
+                )
+        finally:
+            os.close(dir_fd)
+        return (plan, stats, out)
+
+    def _apply_batch(self, plan: _Plan, options: ShifterOptions) -> ShifterStats:
+        assert plan.dir_path is not None
+        stats = ShifterStats()
+        try:
+            dir_fd = plan.open_dir()
+        except OSError as e:
+            _handle_shift_error(plan.dir_path, e, options, stats)
+            for i in range(len(plan.names)):
+                _uncount_shift(plan, i, stats)
+            return stats
+        try:
+            self._apply(plan, options, stats, dir_fd)
+        finally:
+            os.close(dir_fd)
+        return stats
 
     def run(
         self, path: str, options: ShifterOptions = ShifterOptions()
     ) -> ShifterStats:
         stats = ShifterStats()
-
-        self.shift(Path(path), options, stats)
-        for root, dirs, files in os.walk(path, followlinks=False):
-            for d in dirs:
-                self.shift(Path(root) / d, options, stats)
-
-            for f in files:
-                self.shift(Path(root) / f, options, stats)
+        # Normalize the root path the way pathlib does (no "./" prefix, no trailing
+        # "/"...), as that's the form the exclusion globs are matched against.
+        path = str(PurePath(path))
+
+        max_workers = options.max_workers
+        if max_workers is None:
+            max_workers = _default_max_workers()
+
+        # First go through the whole tree and work out what needs shifting, then
+        # perform all the changes in a second sweep. The metadata syscalls of both
+        # sweeps release the GIL, so they are fanned out to a pool of workers, one
+        # batch per directory. Note that the plans for the whole tree are kept in
+        # memory between the two sweeps.
+        root_plan = _Plan()
+        self._plan(path, options, stats, plan=root_plan)
+        # Don't report the root path twice if it already couldn't be stat'ed.
+        walk = self._walk(path, options, stats) if stats.errors == 0 else iter(())
+        plans = []
+        write = sys.stdout.write
+        for plan, batch_stats, out in _run_batches(
+            self._plan_batch,
+            (
+                (dir_path, entries, options, dir_path == path)
+                for dir_path, entries in walk
+            ),
+            max_workers,
+        ):
+            stats.merge(batch_stats)
+            if out:
+                write("".join(out))
+            if plan.names:
+                plans.append((plan, options))
+
+        if options.dry_run:
+            return stats
+
+        self._apply(root_plan, options, stats)
+        for batch_stats in _run_batches(self._apply_batch, plans, max_workers):
+            stats.merge(batch_stats)
 
         return stats